@@ -1,56 +1,113 @@
+from __future__ import annotations
+
 import os
 import base64
+import shutil
 import sys
 import argparse
-from mistralai import Mistral, OCRResponse, OCRImageObject
-from mistralai.extra import response_format_from_pydantic_model
+import asyncio
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+import orjson
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-import re
-from datauri import parse
 
-load_dotenv()
+# mistralai (and httpx) are only imported when they are needed, as they are slow to import
+if TYPE_CHECKING:
+    from mistralai import Mistral, OCRResponse, OCRImageObject
+
+# Delay between two status checks of a Mistral batch job
+BATCH_POLL_INTERVAL_SECONDS = 10
+# Statuses of a Mistral batch job that is not finished yet (a cancellation request still has to complete)
+BATCH_PENDING_STATUSES = ("QUEUED", "RUNNING", "CANCELLATION_REQUESTED")
+
+# Number of updated pages, or delay in seconds, after which the whole json file is rewritten
+# (updated pages are recorded in a much smaller partial file in between)
+CHECKPOINT_EVERY_PAGES = 10
+CHECKPOINT_EVERY_SECONDS = 5.0
+
+TRANSFORM_SYSTEM_PROMPT = (
+    "You are an expert programmer who excels at fixing markdown text so that it is valid markdown.\n"
+    "Important rules:\n"
+    "- When updating text that is in markdown, you excel at preversing the markdown formatting (headings, tables) in the output text while also making sure that it is valid.\n"
+    "  For instance:\n"
+    "  - IMPORTANT: Ensure that headers are displayed on a standalone line in the resulting text, especially if they are on a standalone line in the source text.\n"
+    "  - Ensure that headers are displayed on a separate line, especially if they are numbered and you identify a gap in the sequence because the header is at the end of an existing line.\n"
+    "  - Ensure that table headers and cells are on a single line, potentially replacing '\\n' text with '<br>' to fix markdown\n"
+    "  - Ensure that all rows in a table containing (including headers) have the same number of columns. If this is not the case, add empty columns to the row missing columns.\n"
+    "- When translating markdown that contains LaTex, you do not modify the Latex commands.\n"
+    "  For instance:\n"
+    "  - '$\\square$' is preserved as is\n"
+    "  - '$\\qquad$' is preserved as is\n"
+    "  - '$\\checkmark$' is preserved as is\n"
+    "  In particular, you should never replace Latex with a resulting '$$' as it is invalid LaTex.\n"
+)
+
+# Formatted with the source and destination language codes
+TRANSLATE_SYSTEM_PROMPT_TEMPLATE = (
+    "You are an expert translator working from language code(s) {src_language_codes} to language code {dest_language_code}.\n"
+    "Important rules:\n"
+    "- Wrap each block of translated text into a block as follows:\n"
+    "    <section source_language_code=\"es\">\n"
+    "    Hello\n"
+    "    </section>\n"
+    "  where source_language_code indicate the actual source language.\n"
+    "  Always write the <section> tags on a separate line.\n"
+    "  Always write the </section> tags on a separate lines.\n"
+    "- When translating content that contains multiple languages, translate the content in all the languages even if it menas there are redundancies in the translated output text."
+    "- When translating text that is in markdown, preserve the markdown formatting in the output text while also making sure that it is valid.\n"
+    "  For instance:\n"
+    "  - Headers (line stating with # or ## or ###) are displayed on a separate line, especially if they are on a separate line in the source text.\n"
+    "  - Headers are always preceded by an empty line.\n"
+    "  - Paragraphs and empty lines in the source text are preserved in the output text.\n"
+    "  - Table headers and cells are on a single line, potentially replacing '\\n' text with '<br>' to fix markdown\n"
+    "  - All rows in a table containing (including headers) have the same number of columns. If this is not the case, add empty columns to the row missing columns.\n"
+    "- When translating markdown that contains LaTex, you do not modify the Latex commands.\n"
+    "  For instance:\n"
+    "  - '$\\square$' is preserved as is\n"
+    "  - '$\\qquad$' is preserved as is\n"
+    "  - '$\\checkmark$' is preserved as is\n"
+    "  In particular, you should never replace Latex with a resulting '$$' as it is invalid LaTex.\n"
+)
+
+# Rules added to the system prompt when several pages are sent in a single request
+MULTI_PAGE_INSTRUCTIONS = (
+    "- The text contains several pages, each one wrapped into a <page id=\"...\"> block.\n"
+    "  Process each page independently and return one text per page, in the same order as the pages.\n"
+    "  Never merge or split pages, and do not include the <page> tags in the returned texts.\n"
+)
+
+# Last OCRResponse saved to each json file, with the file modification time at save time
+_JSON_CACHE: dict[str, tuple[int, OCRResponse]] = {}
+
+# Digest of the content of each json file read or written by this process, with the file modification time,
+# to skip rewriting a json file with identical content
+_JSON_DIGESTS: dict[str, tuple[int, bytes]] = {}
+
+# Chat requests made by this process, keyed by a digest of their content, so that identical pages (repeated headers,
+# blank pages, ...) are only sent once, even while the first request is still in flight
+_CHAT_RESULTS: dict[bytes, asyncio.Task] = {}
 
-def encode_pdf(pdf_path):
-    """Encode the pdf to base64."""
-    try:
-        with open(pdf_path, "rb") as pdf_file:
-            return base64.b64encode(pdf_file.read()).decode('utf-8')
-    except FileNotFoundError:
-        print(f"Error: The file '{pdf_path}' was not found.")
-        return None
-    except Exception as e:  # Added general exception handling
-        print(f"Error: {e}")
-        return None
-    
 class TransformationOutput(BaseModel):
     text: str = Field(description="The transformed text")
 
+class MultiPageTransformationOutput(BaseModel):
+    texts: list[str] = Field(description="The transformed text of each page, in the same order as the pages")
+
 # BBOX Annotation response formats
 class Image(BaseModel):
   image_type: str = Field(..., description="The type of the image.")
   short_description: str = Field(..., description="A description in english describing the image.")
   summary: str = Field(..., description="Summarize the image.")
 
-def transform(client, src_language_codes: str, src_content: str, dest_language_code: str) -> TransformationOutput | None:
-    messages = [
+def get_chat_messages(system_prompt: str, src_content: str) -> list[dict]:
+    return [
         { 
             "role": "system", 
-            "content": (f"You are an expert programmer who excels at fixing markdown text so that it is valid markdown.\n"
-                        "Important rules:\n"
-                        "- When updating text that is in markdown, you excel at preversing the markdown formatting (headings, tables) in the output text while also making sure that it is valid.\n"
-                        "  For instance:\n"
-                        "  - IMPORTANT: Ensure that headers are displayed on a standalone line in the resulting text, especially if they are on a standalone line in the source text.\n"
-                        "  - Ensure that headers are displayed on a separate line, especially if they are numbered and you identify a gap in the sequence because the header is at the end of an existing line.\n"
-                        "  - Ensure that table headers and cells are on a single line, potentially replacing '\\n' text with '<br>' to fix markdown\n"
-                        "  - Ensure that all rows in a table containing (including headers) have the same number of columns. If this is not the case, add empty columns to the row missing columns.\n"
-                        "- When translating markdown that contains LaTex, you do not modify the Latex commands.\n"
-                        "  For instance:\n"
-                        "  - '$\\square$' is preserved as is\n"
-                        "  - '$\\qquad$' is preserved as is\n"
-                        "  - '$\\checkmark$' is preserved as is\n"
-                        "  In particular, you should never replace Latex with a resulting '$$' as it is invalid LaTex.\n"
-                        ) 
+            "content": system_prompt
         },
         { 
             "role": "user", 
@@ -58,136 +115,430 @@ def transform(client, src_language_codes: str, src_content: str, dest_language_c
         }
     ]
 
+def get_transform_messages(src_language_codes: str, src_content: str, dest_language_code: str) -> list[dict]:
+    return get_chat_messages(TRANSFORM_SYSTEM_PROMPT, src_content)
+
+def get_translate_messages(src_language_codes: str, src_content: str, dest_language_code: str) -> list[dict]:
+    system_prompt = TRANSLATE_SYSTEM_PROMPT_TEMPLATE.format(src_language_codes=src_language_codes, dest_language_code=dest_language_code)
+    return get_chat_messages(system_prompt, src_content)
+
+def get_chat_digest(messages: list[dict], response_format: type[BaseModel]) -> bytes:
+    digest = hashlib.blake2b(response_format.__name__.encode())
+    for message in messages:
+        digest.update(b"\x00" + message["content"].encode())
+    return digest.digest()
+
+async def parse_chat(client, messages: list[dict], response_format: type[BaseModel]) -> BaseModel | None:
+    chat_digest = get_chat_digest(messages, response_format)
+    task = _CHAT_RESULTS.get(chat_digest)
+    if task is None:
+        task = _CHAT_RESULTS[chat_digest] = asyncio.create_task(request_chat(client, messages, response_format))
+
+    # Shielded so that a cancelled caller does not cancel the request for the other callers
+    response = await asyncio.shield(task)
+    if response is None and _CHAT_RESULTS.get(chat_digest) is task:
+        # Do not keep failures, the request can be retried (unless a retry was already started by another caller)
+        del _CHAT_RESULTS[chat_digest]
+    return response
+
+async def request_chat(client, messages: list[dict], response_format: type[BaseModel]) -> BaseModel | None:
     # Make the chat completion request
     try:
-        chat_response = client.chat.parse(
+        chat_response = await client.chat.parse_async(
             model="mistral-medium-latest",
-            response_format=TransformationOutput,
+            response_format=response_format,
             temperature=0,
             messages=messages
         )
-
-        # Print the model's response
-        response: TransformationOutput =  (chat_response.choices[0].message.parsed)
-        return response
+        return chat_response.choices[0].message.parsed
 
     except Exception as e:
         print(f"🛑 An error occurred: {e}")
         return None
-    
-def translate(client, src_language_codes: str, src_content: str, dest_language_code: str) -> TransformationOutput | None:
-    # Define the messages for the chat completion
-    messages = [
-        { 
-            "role": "system", 
-            "content": (f"You are an expert translator working from language code(s) {src_language_codes} to language code {dest_language_code}.\n"
-                        "Important rules:\n"
-                        "- Wrap each block of translated text into a block as follows:\n"
-                        "    <section source_language_code=\"es\">\n"
-                        "    Hello\n"
-                        "    </section>\n"
-                        "  where source_language_code indicate the actual source language.\n"
-                        "  Always write the <section> tags on a separate line.\n"
-                        "  Always write the </section> tags on a separate lines.\n"
-                        "- When translating content that contains multiple languages, translate the content in all the languages even if it menas there are redundancies in the translated output text."
-                        "- When translating text that is in markdown, preserve the markdown formatting in the output text while also making sure that it is valid.\n"
-                        "  For instance:\n"
-                        "  - Headers (line stating with # or ## or ###) are displayed on a separate line, especially if they are on a separate line in the source text.\n"
-                        "  - Headers are always preceded by an empty line.\n"
-                        "  - Paragraphs and empty lines in the source text are preserved in the output text.\n"
-                        "  - Table headers and cells are on a single line, potentially replacing '\\n' text with '<br>' to fix markdown\n"
-                        "  - All rows in a table containing (including headers) have the same number of columns. If this is not the case, add empty columns to the row missing columns.\n"
-                        "- When translating markdown that contains LaTex, you do not modify the Latex commands.\n"
-                        "  For instance:\n"
-                        "  - '$\\square$' is preserved as is\n"
-                        "  - '$\\qquad$' is preserved as is\n"
-                        "  - '$\\checkmark$' is preserved as is\n"
-                        "  In particular, you should never replace Latex with a resulting '$$' as it is invalid LaTex.\n"
-                        ) 
-        },
-        { 
-            "role": "user", 
-            "content": src_content 
-        }
+
+async def transform(client, src_language_codes: str, src_content: str, dest_language_code: str) -> TransformationOutput | None:
+    return await parse_chat(client, get_transform_messages(src_language_codes, src_content, dest_language_code), TransformationOutput)
+
+async def translate(client, src_language_codes: str, src_content: str, dest_language_code: str) -> TransformationOutput | None:
+    return await parse_chat(client, get_translate_messages(src_language_codes, src_content, dest_language_code), TransformationOutput)
+
+async def process_multiple_pages(client, get_messages, src_language_codes: str, src_contents: list[str], dest_language_code: str) -> list[TransformationOutput] | None:
+    """Process several pages in a single chat request, which saves sending the system prompt for each page.
+    Returns None if the pages could not be processed together."""
+    user_content = "\n".join(f"<page id=\"{page_number}\">\n{src_content}\n</page>" for page_number, src_content in enumerate(src_contents))
+    messages = get_messages(src_language_codes, user_content, dest_language_code)
+    messages[0]["content"] += MULTI_PAGE_INSTRUCTIONS
+
+    response: MultiPageTransformationOutput | None = await parse_chat(client, messages, MultiPageTransformationOutput)
+    if response is None:
+        return None
+
+    if len(response.texts) != len(src_contents):
+        print(f"⚠️ Got {len(response.texts)} pages back instead of {len(src_contents)}, processing the pages one by one")
+        return None
+    return [TransformationOutput(text=text) for text in response.texts]
+
+async def run_concurrently(fn, get_messages, client, src_language_codes: str, pages: dict[int, str], dest_language_code: str, max_concurrency: int, pages_per_request: int = 1):
+    """Call fn (transform or translate) on each page concurrently, yielding (page_index, output) as pages complete.
+    Consecutive pages are grouped by pages_per_request and sent in a single request built with get_messages."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_pages(page_indexes: list[int], src_contents: list[str]) -> list[tuple[int, TransformationOutput | None]]:
+        async with semaphore:
+            outputs = None
+            if len(src_contents) > 1:
+                outputs = await process_multiple_pages(client, get_messages, src_language_codes, src_contents, dest_language_code)
+            if outputs is None:
+                outputs = [await fn(client, src_language_codes, src_content, dest_language_code) for src_content in src_contents]
+            return list(zip(page_indexes, outputs))
+
+    page_items = list(pages.items())
+    page_groups = [page_items[i:i + pages_per_request] for i in range(0, len(page_items), pages_per_request)]
+    for group_result in asyncio.as_completed([
+        run_pages([page_index for page_index, _ in page_group], [src_content for _, src_content in page_group])
+        for page_group in page_groups
+    ]):
+        for page_result in await group_result:
+            yield page_result
+
+async def delete_file(client, file_id: str):
+    """Delete a file uploaded to (or created in) Mistral. Failing to clean up is only reported, so that it doesn't lose the results."""
+    try:
+        await client.files.delete_async(file_id=file_id)
+    except Exception as e:
+        print(f"⚠️ Could not delete file {file_id}: {e}")
+
+async def run_batch(client, messages_by_page: dict[int, list[dict]]):
+    """Run the chat requests through the Mistral batch API, yielding (page_index, output) once the batch job completes."""
+    from mistralai.extra import response_format_from_pydantic_model
+
+    results: dict[int, TransformationOutput | None] = {page_index: None for page_index in messages_by_page}
+    response_format = response_format_from_pydantic_model(TransformationOutput).model_dump(mode="json", by_alias=True, exclude_unset=True)
+    batch_lines = [
+        json.dumps({
+            "custom_id": f"page_{page_index}",
+            "body": {
+                "messages": messages,
+                "temperature": 0,
+                "response_format": response_format
+            }
+        })
+        for page_index, messages in messages_by_page.items()
     ]
 
-    # Make the chat completion request
+    batch_file = None
     try:
-        chat_response = client.chat.parse(
-            model="mistral-medium-latest",
-            response_format=TransformationOutput,
-            temperature=0,
-            messages=messages
+        batch_file = await client.files.upload_async(
+            file={
+                "file_name": "batch.jsonl",
+                "content": "\n".join(batch_lines).encode("utf-8")
+            },
+            purpose="batch"
         )
-
-        # Print the model's response
-        response: TransformationOutput =  (chat_response.choices[0].message.parsed)
-        return response
-
+        job = await client.batch.jobs.create_async(
+            input_files=[batch_file.id],
+            endpoint="/v1/chat/completions",
+            model="mistral-medium-latest"
+        )
+        print(f"📦 Batch job {job.id} created for {len(batch_lines)} pages")
+
+        try:
+            while job.status in BATCH_PENDING_STATUSES:
+                await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+                job = await client.batch.jobs.get_async(job_id=job.id)
+                print(f"⏳ Batch job {job.id} is {job.status} ({job.completed_requests}/{job.total_requests} pages completed)")
+        except asyncio.CancelledError:
+            # Don't leave the job running (and billed) when the application is interrupted
+            print(f"🛑 Cancelling batch job {job.id}")
+            try:
+                await client.batch.jobs.cancel_async(job_id=job.id)
+            except Exception as e:
+                print(f"⚠️ Could not cancel batch job {job.id}: {e}")
+            raise
+
+        if job.status != "SUCCESS":
+            print(f"🛑 Batch job {job.id} ended with status {job.status}")
+        if not job.output_file:
+            output = ""
+        else:
+            output_response = await client.files.download_async(file_id=job.output_file)
+            output = (await output_response.aread()).decode("utf-8")
+            await delete_file(client, job.output_file)
     except Exception as e:
         print(f"🛑 An error occurred: {e}")
+        output = ""
+    finally:
+        if batch_file is not None:
+            await delete_file(client, batch_file.id)
+
+    # A malformed line only loses its own page, the other results of the job are kept
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            page_index = int(entry["custom_id"].removeprefix("page_"))
+        except Exception as e:
+            print(f"🛑 An error occurred reading batch output line {line[:100]!r}: {e}")
+            continue
+        try:
+            content = entry["response"]["body"]["choices"][0]["message"]["content"]
+            results[page_index] = TransformationOutput.model_validate_json(content)
+        except Exception as e:
+            print(f"🛑 An error occurred on page index {page_index}: {entry.get('error') or e}")
+
+    for page_index, output in results.items():
+        yield page_index, output
+
+def batch_transform(client, src_language_codes: str, pages: dict[int, str], dest_language_code: str):
+    return run_batch(client, {
+        page_index: get_transform_messages(src_language_codes, src_content, dest_language_code)
+        for page_index, src_content in pages.items()
+    })
+
+def batch_translate(client, src_language_codes: str, pages: dict[int, str], dest_language_code: str):
+    return run_batch(client, {
+        page_index: get_translate_messages(src_language_codes, src_content, dest_language_code)
+        for page_index, src_content in pages.items()
+    })
+
+def get_json_digest(response_json: bytes) -> bytes:
+    return hashlib.blake2b(response_json, digest_size=16).digest()
+
+def get_mtime_ns(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_size(path: str) -> int | None:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
         return None
 
 def load_json_response(json_path:str) -> OCRResponse:
     """ Load the json file into an OCRResponse. """
+    from mistralai import OCRResponse
 
-    with open(json_path, "r", encoding="utf-8") as json_file:
+    # Skip parsing the file if it is unchanged since it was saved by this process
+    cached = _JSON_CACHE.get(json_path)
+    if cached is not None and cached[0] == os.stat(json_path).st_mtime_ns:
+        return cached[1]
+
+    # pydantic parses the raw bytes directly, which is faster than decoding them first
+    with open(json_path, "rb") as json_file:
         response_json = json_file.read()
-        return OCRResponse.model_validate_json(response_json)
+    _JSON_DIGESTS[json_path] = (os.stat(json_path).st_mtime_ns, get_json_digest(response_json))
+    return OCRResponse.model_validate_json(response_json)
     
-def save_json_response(ocr_response: OCRResponse, json_path: str):
-    with open(json_path, "wt", encoding="utf-8") as json_file:
-        json_file.write(ocr_response.model_dump_json(indent=2, round_trip=True))    
+def save_json_response(ocr_response: OCRResponse, json_path: str, pretty: bool = False):
+    """Write the OCRResponse to the json file. The json is compact unless pretty is set, as it is mostly reloaded by this tool."""
+    # orjson serializes the dumped model about twice as fast as model_dump_json, with the same output
+    response_data = ocr_response.model_dump(mode="json")
+    response_json = orjson.dumps(response_data, option=orjson.OPT_INDENT_2 if pretty else None)
+
+    # Skip the write if the file already has this exact content
+    digest = get_json_digest(response_json)
+    if _JSON_DIGESTS.get(json_path) != (get_mtime_ns(json_path), digest):
+        with open(json_path, "wb") as json_file:
+            json_file.write(response_json)
+        _JSON_DIGESTS[json_path] = (os.stat(json_path).st_mtime_ns, digest)
+
+    _JSON_CACHE[json_path] = (os.stat(json_path).st_mtime_ns, ocr_response)
+
+def copy_pages(ocr_response: OCRResponse) -> OCRResponse:
+    """Copy the OCRResponse so that its pages markdown can be updated.
+    Only the pages are copied, the rest (e.g. images) is shared with the original response."""
+    return ocr_response.model_copy(update={"pages": [page.model_copy() for page in ocr_response.pages]})
+
+def get_partial_json_file_path(json_path: str) -> str:
+    return replace_extension(json_path, ".partial.jsonl")
+
+def append_partial_page(json_path: str, page_index: int, markdown: str):
+    """Record an updated page markdown in the partial file next to the json file, which is much cheaper than rewriting the whole json file."""
+    with open(get_partial_json_file_path(json_path), "at", encoding="utf-8") as partial_file:
+        partial_file.write(json.dumps({"idx": page_index, "markdown": markdown}) + "\n")
+
+def replay_partial_pages(ocr_response: OCRResponse, json_path: str) -> int:
+    """Apply the page updates recorded in the partial file (left by an interrupted run) to the OCRResponse."""
+    partial_path = get_partial_json_file_path(json_path)
+    if not os.path.exists(partial_path):
+        return 0
+
+    replayed_pages = 0
+    with open(partial_path, "rt", encoding="utf-8") as partial_file:
+        for line in partial_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line is incomplete if the application stopped while writing it
+                break
+            ocr_response.pages[entry["idx"]].markdown = entry["markdown"]
+            replayed_pages += 1
+    return replayed_pages
+
+def save_json_checkpoint(ocr_response: OCRResponse, json_path: str, pretty: bool = False):
+    """Write the whole OCRResponse to the json file, which makes the partial file obsolete."""
+    save_json_response(ocr_response, json_path, pretty)
+    partial_path = get_partial_json_file_path(json_path)
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+async def update_pages(ocr_response: OCRResponse, json_path: str, page_outputs, updated_label: str, pretty: bool = False):
+    """Update the pages markdown with the (page_index, output) as they complete, checkpointing them along the way.
+    The whole json file is always rewritten before returning, even on failure."""
+    pages_since_checkpoint = 0
+    last_checkpoint_time = time.monotonic()
+    try:
+        async for page_index, output in page_outputs:
+            if output is None:
+                print(f"⚠️ Page {page_index+1} (page index {page_index}) was skipped")
+                continue
+
+            print(f"✅ {updated_label} page {page_index+1}/{len(ocr_response.pages)} (page index {page_index})")
+            ocr_response.pages[page_index].markdown = output.text
+            # Record the updated markdown in the partial file, and only rewrite the whole json file every few pages or seconds.
+            # Updating the state prevent gratuitious translation on application failure.
+            append_partial_page(json_path, page_index, output.text)
+            pages_since_checkpoint += 1
+            if pages_since_checkpoint >= CHECKPOINT_EVERY_PAGES or time.monotonic() - last_checkpoint_time >= CHECKPOINT_EVERY_SECONDS:
+                await asyncio.to_thread(save_json_checkpoint, ocr_response, json_path, pretty)
+                pages_since_checkpoint = 0
+                last_checkpoint_time = time.monotonic()
+    finally:
+        if pages_since_checkpoint:
+            await asyncio.to_thread(save_json_checkpoint, ocr_response, json_path, pretty)
+
+def save_image(dir: str, ocr_image: OCRImageObject, overwrite: bool = True):
+    image_path = os.path.join(dir, ocr_image.id)
+    if not overwrite and os.path.exists(image_path) and os.path.getsize(image_path) > 0:
+        return
+
+    # image_base64 is always a 'data:image/<format>;base64,<payload>' uri, only the payload needs decoding
+    _, _, payload = ocr_image.image_base64.partition(",")
+    with open(image_path, "wb") as f:
+        f.write(base64.b64decode(payload))
+
+def link_image(images_dir: str, dir: str, ocr_image: OCRImageObject):
+    """Hard link the image saved in images_dir into dir (or copy it if links are not supported), unless it is already there."""
+    src_image_path = os.path.join(images_dir, ocr_image.id)
+    image_path = os.path.join(dir, ocr_image.id)
+    src_image_size = get_size(src_image_path)
+    if src_image_size is None:
+        # Only happens if the raw json file doesn't embed the image either
+        print(f"⚠️ Image {ocr_image.id} is missing from {images_dir}, skipping it")
+        return
+
+    image_size = get_size(image_path)
+    if image_size is not None:
+        # Already linked, or copied where links are not supported (images never change once saved)
+        if image_size == src_image_size:
+            return
+        os.remove(image_path)
 
-def save_image(dir: str, ocr_image: OCRImageObject):
-    data = parse(ocr_image.image_base64)
-    with open(os.path.join(dir, ocr_image.id), "wb") as f:
-        f.write(data.data) 
+    try:
+        os.link(src_image_path, image_path)
+    except OSError:
+        shutil.copyfile(src_image_path, image_path)
+
+def offload_images(ocr_response: OCRResponse, images_dir: str, overwrite: bool = True):
+    """Save the images to images_dir and drop their base64 from the OCRResponse, so that they are not kept in memory
+    (nor in the json files). The markdown only references the images by id.
+    Unless overwrite is set, images already saved in images_dir are not decoded again."""
+    for page in ocr_response.pages:
+        for ocr_image in page.images:
+            if ocr_image.image_base64:
+                save_image(images_dir, ocr_image, overwrite)
+                ocr_image.image_base64 = None
 
 def get_dir(path: str) -> str:
      dir, _ = os.path.split(path)
      return dir
 
-def get_filename_no_extension(path: str) -> str:
-    _, filename = os.path.split(path)
-    filename_notext, _ = os.path.splitext(filename)
-    return filename_notext
-
 def replace_extension(path: str, extension: str) -> str:
     return os.path.splitext(path)[0] + (extension if extension.startswith('.') else '.' + extension)
 
-def get_md_single_page_file_path(md_file_path: str, page_index: int) -> str:
-    return f"{os.path.splitext(md_file_path)[0]}_page_{page_index+1}.md"
+def save_markdown(md_file_path: str, markdown: str):
+    """Write the markdown to the file, unless the file already has this exact content (e.g. when re-running a later step)."""
+    # Bytes as written by the text mode below, newlines included
+    md_bytes = markdown.replace("\n", os.linesep).encode("utf-8")
+    if get_size(md_file_path) == len(md_bytes):
+        with open(md_file_path, "rb") as md_file:
+            if md_file.read() == md_bytes:
+                return
+
+    with open(md_file_path, "wt", encoding="utf-8") as md_file:
+        md_file.write(markdown)
+
+def save_ocr_response_to_file(ocr_response: OCRResponse, md_file_path: str, images_dir: str):
+    """Write the OCRResponse to the md files, overwritting the files if they already exist.
+    The images must have been offloaded to images_dir (see offload_images), they are linked from there."""
 
-def save_ocr_response_to_file(ocr_response: OCRResponse, md_file_path: str):
-    """Write the OCRResponse to the json file, overwritting the file if it already exists."""
+    # Clean up each page markdown only once, for both the single md file and the one page per md files
+    markdowns = [cleanup_markdown(page.markdown) for page in ocr_response.pages]
 
     # Save all pages into a single md file
-    with open(md_file_path, "wt", encoding="utf-8") as md_file:
-        for page in ocr_response.pages:
-            md_file.write(cleanup_markdown(page.markdown))
+    save_markdown(md_file_path, "".join(markdowns))
 
-    # Save images
+    # Save one page per md file and the images.
+    # These are small independent files, they are written concurrently.
     md_file_dir = get_dir(md_file_path)
-    for page in ocr_response.pages:
-        for ocr_image in page.images:
-            save_image(md_file_dir, ocr_image)
-
-    # Save one page per md file
-    for page_index, page in enumerate(ocr_response.pages):
-        md_single_page_path = get_md_single_page_file_path(md_file_path, page_index)
-        with open(md_single_page_path, "wt", encoding="utf-8") as md_single_page_file:
-            md_single_page_file.write(cleanup_markdown(page.markdown))
+    md_file_path_notext = os.path.splitext(md_file_path)[0]
+    link_images = os.path.abspath(images_dir) != os.path.abspath(md_file_dir)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        futures = []
+        for page_index, (page, markdown) in enumerate(zip(ocr_response.pages, markdowns)):
+            md_single_page_path = f"{md_file_path_notext}_page_{page_index+1}.md"
+            futures.append(executor.submit(save_markdown, md_single_page_path, markdown))
+
+            if link_images:
+                for ocr_image in page.images:
+                    futures.append(executor.submit(link_image, images_dir, md_file_dir, ocr_image))
+
+        # Surface any write error
+        for future in futures:
+            future.result()
+
+def replace_single_newlines(md: str) -> str:
+    r"""Replace single \n (not part of consecutive \n) with '  \n' with a single scan of the lines."""
+    lines = md.split('\n')
+    last_line_index = len(lines) - 1
+    parts = []
+    for line_index, line in enumerate(lines):
+        parts.append(line)
+        if line_index == last_line_index:
+            break
+        # The \n following the line is preceded by another \n if the line is empty (except at the start of the text)
+        # and followed by another \n if the next line is empty (except at the end of the text)
+        if (line == '' and line_index > 0) or (lines[line_index + 1] == '' and line_index + 1 < last_line_index):
+            parts.append('\n')
+        else:
+            parts.append('  \n')
+    return ''.join(parts)
 
 def cleanup_markdown(md: str) -> str:
     # Replace single \n (not part of double \n) with '  \n'
-    #   Negative lookbehind and lookahead to avoid replacing when there are two consecutive \n
     # Other rules as needed...
     tmp = md
-    tmp = re.sub(r'(?<!\n)\n(?!\n)', '  \n', tmp)
+    if '\n' not in tmp:
+        # Nothing to replace (e.g. empty page)
+        return tmp
+    if '\x00' in tmp:
+        tmp = replace_single_newlines(tmp)
+    else:
+        # Same substitution as replace_single_newlines using str.replace only, which is faster on large pages:
+        # protect consecutive \n with a \x00 sentinel, replace the remaining \n, then restore the sentinel.
+        # A \n left after the sentinel (odd number of consecutive \n) is part of the run and must not be replaced.
+        tmp = (tmp.replace('\n\n', '\x00')
+                  .replace('\n', '  \n')
+                  .replace('\x00  \n', '\x00\n')
+                  .replace('\x00', '\n\n'))
     return tmp
 
-def main():
+async def main():
+    load_dotenv()
+
     parser = argparse.ArgumentParser(description="OCR and translate PDF documents using Mistral.")
     parser.add_argument("--input", required=True, help="Path to the input PDF file.")
     parser.add_argument("--source", required=True, help="Source language code(s). Language codes are comma-separated if multiple source languages are present.")
@@ -196,6 +547,10 @@ def main():
     parser.add_argument("--force_ocr_post_process", action="store_true", help="Force transforming raw.scr to src.")
     parser.add_argument("--force_translate", action="store_true", help="Force document translation, overwritting existing raw.target translation files if needed")
     parser.add_argument("--limit_to_pages", required=False, help="Comma-separated list of pages to process (e.g., '1,3,5').")
+    parser.add_argument("--max_concurrency", type=int, default=8, help="Maximum number of pages sent concurrently to Mistral (default: 8).")
+    parser.add_argument("--pages_per_request", type=int, default=1, help="Number of pages sent to Mistral in a single post-processing or translation request (default: 1).")
+    parser.add_argument("--pretty_json", action="store_true", help="Indent the json files so that they are easier to read and diff.")
+    parser.add_argument("--use_batch", action="store_true", help="Post-process and translate pages with the Mistral batch API (cheaper, but adds latency).")
     args = parser.parse_args()
 
     pdf_path = os.path.abspath(os.path.normpath(args.input))
@@ -211,32 +566,55 @@ def main():
     force_translate = args.force_translate
     limit_to_pages_str = args.limit_to_pages
     limit_to_pages = [int(p) for p in limit_to_pages_str.split(',')] if limit_to_pages_str else []
+    max_concurrency = max(1, args.max_concurrency)
+    use_batch = args.use_batch
+    pages_per_request = max(1, args.pages_per_request)
+    pretty_json = args.pretty_json
 
-    # Create directories for the source and target files
-    raw_src_language_dir : str = os.path.join(os.path.splitext(pdf_path)[0], "raw." + src_language_code)
+    # Mistral client initialization
+    import httpx
+    from mistralai import Mistral
+
+    api_key = os.environ["MISTRAL_API_KEY"]
+    if not api_key:
+        raise ValueError("MISTRAL_API_KEY not found in environment variables.")
+
+    # All the Mistral requests share a single connection pool, sized for the concurrent page requests,
+    # so that connections (and TLS sessions) are reused from the OCR request to the last translation
+    async with (
+        httpx.AsyncClient(limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)) as http_client,
+        Mistral(api_key=api_key, async_client=http_client) as client
+    ):
+        await process_document(
+            client, pdf_path, src_language_code, target_language_code,
+            force_ocr, force_ocr_post_process, force_translate, limit_to_pages,
+            max_concurrency, pages_per_request, use_batch, pretty_json
+        )
+
+async def process_document(
+    client: Mistral, pdf_path: str, src_language_code: str, target_language_code: str,
+    force_ocr: bool, force_ocr_post_process: bool, force_translate: bool, limit_to_pages: list[int],
+    max_concurrency: int, pages_per_request: int, use_batch: bool, pretty_json: bool
+):
+    # Create directories for the source and target files, in a directory named after the pdf file
+    pdf_path_notext = os.path.splitext(pdf_path)[0]
+    raw_src_language_dir : str = os.path.join(pdf_path_notext, "raw." + src_language_code)
     os.makedirs(raw_src_language_dir, exist_ok = True)
     print(f"⬆️  Raw source directory: {raw_src_language_dir}")
 
-    src_language_dir : str = os.path.join(os.path.splitext(pdf_path)[0], src_language_code)
+    src_language_dir : str = os.path.join(pdf_path_notext, src_language_code)
     os.makedirs(src_language_dir, exist_ok = True)
     print(f"➡️  Source directory: {src_language_dir}")
 
-    raw_target_language_dir : str = os.path.join(os.path.splitext(pdf_path)[0], "raw." + target_language_code)
+    raw_target_language_dir : str = os.path.join(pdf_path_notext, "raw." + target_language_code)
     os.makedirs(raw_target_language_dir, exist_ok = True)
     print(f"➡️  Raw target directory: {raw_target_language_dir}")
 
-    target_language_dir : str = os.path.join(os.path.splitext(pdf_path)[0], target_language_code)
+    target_language_dir : str = os.path.join(pdf_path_notext, target_language_code)
     os.makedirs(target_language_dir, exist_ok = True)
     print(f"⬇️  Target directory: {target_language_dir}")
 
-    # Mistral client initialization
-    api_key = os.environ["MISTRAL_API_KEY"]
-    if not api_key:
-        raise ValueError("MISTRAL_API_KEY not found in environment variables.")
-
-    client : Mistral = Mistral(api_key=api_key)
-
-    pdf_filename_notext= get_filename_no_extension(pdf_path)
+    pdf_filename_notext = os.path.basename(pdf_path_notext)
 
     # Write the JSON string to a file with the same name as pdf_path but .json extension
     raw_src_json_filepath = os.path.join(raw_src_language_dir, pdf_filename_notext + ".raw." + src_language_code + ".json")
@@ -244,77 +622,113 @@ def main():
     # Only do the OCR if the output file doesn't exist
     if not os.path.exists(raw_src_json_filepath) or force_ocr:
         print(f"👓 OCRing file {pdf_path}")
-        
-        # Convert the pdf file to a base64 string
-        base64_pdf = encode_pdf(pdf_path)
-        
-        # OCR the base64 encoded PDF file
-        ocr_src_response : OCRResponse = client.ocr.process(
-            model="mistral-ocr-latest",
-            document={
-                "type": "document_url",
-                "document_url": f"data:application/pdf;base64,{base64_pdf}" 
-            },
-            bbox_annotation_format=response_format_from_pydantic_model(Image),
-            include_image_base64=True
-            # include doc and image parsing....
-        )
+        from mistralai.extra import response_format_from_pydantic_model
+
+        # Upload the file so that it doesn't have to be base64 encoded in the OCR request
+        with open(pdf_path, "rb") as pdf_file:
+            uploaded_pdf = await client.files.upload_async(
+                file={
+                    "file_name": os.path.basename(pdf_path),
+                    "content": pdf_file
+                },
+                purpose="ocr"
+            )
+
+        # OCR the uploaded file
+        try:
+            ocr_src_response : OCRResponse = await client.ocr.process_async(
+                model="mistral-ocr-latest",
+                document={
+                    "type": "file",
+                    "file_id": uploaded_pdf.id
+                },
+                bbox_annotation_format=response_format_from_pydantic_model(Image),
+                include_image_base64=True
+                # include doc and image parsing....
+            )
+        finally:
+            await delete_file(client, uploaded_pdf.id)
 
-        # Save the ocr output to a json file
+        # Save the ocr output to a json file. It keeps the images base64, so that the images can be restored from it.
         print(f"💾 Saving raw OCR results to {raw_src_json_filepath}")
-        save_json_response(ocr_src_response, raw_src_json_filepath)
+        await asyncio.to_thread(save_json_response, ocr_src_response, raw_src_json_filepath, pretty_json)
+
+        # Save the images right away rather than keeping them in memory (and in all the other json files)
+        await asyncio.to_thread(offload_images, ocr_src_response, raw_src_language_dir)
     else:
         print(f"♻️ Skipping OCR because file {raw_src_json_filepath} already exists.")
 
     # Load the json file (since OCRing might have been skipped)
     raw_src_response = load_json_response(raw_src_json_filepath)
+    # The raw json file embeds the images, they are offloaded to the raw source directory (which restores any missing image).
+    # Json files from previous versions also embed them, this applies to the other json files below.
+    await asyncio.to_thread(offload_images, raw_src_response, raw_src_language_dir, False)
 
-    # Concatenate all source pages into a single markdown file
+    # Concatenate all source pages into a single markdown file.
+    # The files are written in the background while the pages are post processed.
     raw_src_md_filepath = replace_extension(raw_src_json_filepath, ".md")
-    save_ocr_response_to_file(raw_src_response, raw_src_md_filepath)
+    save_raw_src_md_task = asyncio.create_task(asyncio.to_thread(save_ocr_response_to_file, raw_src_response, raw_src_md_filepath, raw_src_language_dir))
         
     # Transform the pages from raw.<source_language_code> to <source_language_code>
     src_json_filepath = os.path.join(src_language_dir, pdf_filename_notext + "." + src_language_code + ".json")
-    src_response = load_json_response(src_json_filepath) if os.path.exists(src_json_filepath) else raw_src_response.model_copy(deep=True)
-    save_json_response(src_response, src_json_filepath)
+    src_response = load_json_response(src_json_filepath) if os.path.exists(src_json_filepath) else copy_pages(raw_src_response)
+    await asyncio.to_thread(offload_images, src_response, raw_src_language_dir, False)
+    replayed_pages = replay_partial_pages(src_response, src_json_filepath)
+    if replayed_pages:
+        print(f"♻️ Restored {replayed_pages} post processed pages from the previous run")
+    await asyncio.to_thread(save_json_checkpoint, src_response, src_json_filepath, pretty_json)
     
     src_md_filepath = replace_extension(src_json_filepath, ".md")
     print(f"🔁 Post processing {len(raw_src_response.pages)} scanned pages")
+    # List the source directory once rather than checking each single page md file
+    src_md_filename_notext = pdf_filename_notext + "." + src_language_code
+    src_filenames = {entry.name for entry in os.scandir(src_language_dir)}
+    pages_to_transform = []
     for page_index in range(len(raw_src_response.pages)):
         # Only transform if the markdown is identical between the raw source and source for the page
         # and if the single page md file doesn't exist
         # (optimization to prevent transforming pages that have already been transformed)
-        src_md_single_page_path = get_md_single_page_file_path(src_md_filepath, page_index)
+        src_md_single_page_filename = f"{src_md_filename_notext}_page_{page_index+1}.md"
         if(
             (
                 (raw_src_response.pages[page_index].markdown == src_response.pages[page_index].markdown and
-                not os.path.exists(src_md_single_page_path))
+                src_md_single_page_filename not in src_filenames)
                 or force_ocr_post_process
             )
             and (not limit_to_pages or (page_index + 1) in limit_to_pages)
         ):
-            print(f"🔁 Transforming page {page_index+1}/{len(raw_src_response.pages)} (page index {page_index})")
-            new_markdown = transform(client, src_language_code, raw_src_response.pages[page_index].markdown, target_language_code)
-            if new_markdown is None:
-                print(f"⚠️ Page {page_index+1} (page index {page_index}) was skipped")
-            else:
-                src_response.pages[page_index].markdown=new_markdown.text
-                # Write the target json file with the updated markdown.
-                # Updating the state prevent gratuitious translation on application failure.
-                save_json_response(src_response, src_json_filepath)
+            pages_to_transform.append(page_index)
         else:
             print(f"♻️ Skipping page {page_index+1}/{len(src_response.pages)} (page index {page_index})")
+
+    pages = {page_index: raw_src_response.pages[page_index].markdown for page_index in pages_to_transform}
+    for page_index in pages:
+        print(f"🔁 Transforming page {page_index+1}/{len(raw_src_response.pages)} (page index {page_index})")
+    # Pages are independent from each other, transform them concurrently (or as a single batch job).
+    if use_batch and len(pages) > 1:
+        transformed_pages = batch_transform(client, src_language_code, pages, target_language_code)
+    else:
+        transformed_pages = run_concurrently(transform, get_transform_messages, client, src_language_code, pages, target_language_code, max_concurrency, pages_per_request)
+
+    # Results are collected as pages complete, so the response and the json file are only updated from here.
+    await update_pages(src_response, src_json_filepath, transformed_pages, "Transformed", pretty_json)
     print("")
 
-    # Save markdown and images
-    save_ocr_response_to_file(src_response, src_md_filepath)
+    # Save markdown and images in the background while the pages are translated
+    save_src_md_task = asyncio.create_task(asyncio.to_thread(save_ocr_response_to_file, src_response, src_md_filepath, raw_src_language_dir))
 
     # Translate the pages from <source_language_code> to raw.<target_language_code>. 
     raw_target_json_filepath = os.path.join(raw_target_language_dir, pdf_filename_notext + ".raw." + target_language_code + ".json")
-    raw_target_response = load_json_response(raw_target_json_filepath) if os.path.exists(raw_target_json_filepath) else src_response.model_copy(deep=True)
+    raw_target_response = load_json_response(raw_target_json_filepath) if os.path.exists(raw_target_json_filepath) else copy_pages(src_response)
+    await asyncio.to_thread(offload_images, raw_target_response, raw_src_language_dir, False)
+    replayed_pages = replay_partial_pages(raw_target_response, raw_target_json_filepath)
+    if replayed_pages:
+        print(f"♻️ Restored {replayed_pages} translated pages from the previous run")
+        await asyncio.to_thread(save_json_checkpoint, raw_target_response, raw_target_json_filepath, pretty_json)
 
     target_md_filepath = replace_extension(raw_target_json_filepath, ".md") 
     print(f"🔁 Translating {len(src_response.pages)} pages")
+    pages_to_translate = []
     for page_index in range(len(src_response.pages)):
         # Only translate if the markdown is identical between the source and target for the page
         # (optimization to prevent translating pages that have already been translated)
@@ -322,21 +736,27 @@ def main():
             (src_response.pages[page_index].markdown == raw_target_response.pages[page_index].markdown or force_translate)
             and (not limit_to_pages or (page_index + 1) in limit_to_pages)
         ):
-            print(f"🔁 Translating page {page_index+1}/{len(src_response.pages)} (page index {page_index})")
-            translated_markdown = translate(client, src_language_code, src_response.pages[page_index].markdown, target_language_code)
-            if translated_markdown is None:
-                print(f"⚠️ Page {page_index+1} (page index {page_index}) was skipped")
-            else:
-                raw_target_response.pages[page_index].markdown=translated_markdown.text
-                # Write the target json file with the updated translation.
-                # Updating the state prevent gratuitious translation on application failure.
-                save_json_response(raw_target_response, raw_target_json_filepath)
+            pages_to_translate.append(page_index)
         else:
             print(f"♻️ Skipping page {page_index+1}/{len(src_response.pages)} (page index {page_index})")
+
+    pages = {page_index: src_response.pages[page_index].markdown for page_index in pages_to_translate}
+    for page_index in pages:
+        print(f"🔁 Translating page {page_index+1}/{len(src_response.pages)} (page index {page_index})")
+    # Pages are independent from each other, translate them concurrently (or as a single batch job).
+    if use_batch and len(pages) > 1:
+        translated_pages = batch_translate(client, src_language_code, pages, target_language_code)
+    else:
+        translated_pages = run_concurrently(translate, get_translate_messages, client, src_language_code, pages, target_language_code, max_concurrency, pages_per_request)
+
+    # Results are collected as pages complete, so the response and the json file are only updated from here.
+    await update_pages(raw_target_response, raw_target_json_filepath, translated_pages, "Translated", pretty_json)
     print("")
     
     # Save markdown and images
-    save_ocr_response_to_file(raw_target_response, target_md_filepath)
+    await asyncio.to_thread(save_ocr_response_to_file, raw_target_response, target_md_filepath, raw_src_language_dir)
+    await save_raw_src_md_task
+    await save_src_md_task
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())